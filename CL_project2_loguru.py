@@ -29,8 +29,17 @@ except ImportError:
 
 # These libraries are part of either the standard python libraries or 
 #   included in the anaconda packages and are assumed to be installed.
+import argparse
 import asyncio
+import concurrent.futures
+import datetime
+import hashlib
+import math
+import mmap
+import numpy
+import os
 import random
+import re
 import sys
 import time
 #===============================================================================
@@ -55,87 +64,866 @@ def warning_filter(record):
     else:
         return False        
 
-# The logger.remove() method removes all previously defined handlers for the
-#   log messages and in this case, it removes all of the default handlers.
-logger.remove()
-
-# Setting up a handler for logging to the console that styles log messages with
-#   a level of INFO
-logger.add(
-    sys.stderr, 
-    level='INFO', 
-    format='<green>{time}</green> | <GREEN><black>{level}</black></GREEN>' + \
-        '\n{message}', 
-    filter=info_filter
-    )
+# This function builds the text of a log message. Messages about a connection
+#   are logged as an unfilled template with the connection bound to the record,
+#   and are only filled in here, when a handler formats the record. Handlers
+#   whose level or filter rejects the record never call this, and the text is
+#   kept in the record so it is only built once no matter how many handlers
+#   write it.
+# For these records {message} is the unfilled template, so every handler has to
+#   use message_format and {extra[text]} instead. Any other handler, including
+#   loguru's default one when this file is imported without setup_logger,
+#   prints the template as it is.
+# With the handlers in setup_logger every INFO record is written to
+#   web_server.log, so it is the Log_Sampler that skips the work for dropped
+#   messages.
+def render_message(record):
+    if 'text' not in record['extra']:
+        connection = record['extra'].get('connection')
+
+        if connection is None:
+            record['extra']['text'] = record['message']
+        else:
+            record['extra']['text'] = \
+                record['message'].format(connection=connection)
+
+    return record['extra']['text']
+
+# This function returns a handler format function that builds the message text
+#   before returning the layout. The layout uses {extra[text]} in place of
+#   {message}.
+def message_format(layout):
+    def format_record(record):
+        render_message(record)
+        return layout + '\n{exception}'
+
+    return format_record
 
-# Setting up a handler for logging to the console that styles log messages with
-#   a level of WARNING
-logger.add(
-    sys.stderr, 
-    level='WARNING', 
-    format='<yellow>{time}</yellow> | <YELLOW><black>{level}</black></YELLOW>'+\
-        '\n{message}', 
-    filter=warning_filter
-    )    
-
-# Setting up a handler for logging to the console that styles log messages with
-#   a level of CRITICAL
-logger.add(
-    sys.stderr, 
-    level='CRITICAL', 
-    format='<b><red>{time} | <RED><white>{level}</white></RED> ' + \
-        '\n{message}</red></b>'
+# This function sets up all of the handlers for the log messages. It is only
+#   called when this file is run directly, so the process pool's worker
+#   processes don't each add their own handlers for the same log file.
+def setup_logger():
+    # The logger.remove() method removes all previously defined handlers for
+    #   the log messages and in this case, it removes all of the default
+    #   handlers.
+    logger.remove()
+
+    # Setting up a handler for logging to the console that styles log messages
+    #   with a level of INFO
+    logger.add(
+        sys.stderr, 
+        level='INFO', 
+        format=message_format('<green>{time}</green> | ' + \
+            '<GREEN><black>{level}</black></GREEN>\n{extra[text]}'), 
+        filter=info_filter
+        )
+
+    # Setting up a handler for logging to the console that styles log messages
+    #   with a level of WARNING
+    logger.add(
+        sys.stderr, 
+        level='WARNING', 
+        format=message_format('<yellow>{time}</yellow> | ' + \
+            '<YELLOW><black>{level}</black></YELLOW>\n{extra[text]}'), 
+        filter=warning_filter
+        )    
+
+    # Setting up a handler for logging to the console that styles log messages
+    #   with a level of CRITICAL
+    logger.add(
+        sys.stderr, 
+        level='CRITICAL', 
+        format=message_format('<b><red>{time} | ' + \
+            '<RED><white>{level}</white></RED> \n{extra[text]}</red></b>')
+        )
+
+    # Setting up a handler for logging to a file that rotates, deletes and 
+    #   compresses files automatically.
+    logger.add(
+        'web_server.log',
+        level='INFO',
+        format=message_format('{level} | {time} \n{extra[text]}'),
+        rotation='10 kb',
+        retention='10 seconds',
+        compression='zip'
     )
+#===============================================================================
+
 
-# Setting up a handler for logging to a file that rotates, deletes and 
-#   compresses files automatically.
-logger.add(
-    'web_server.log',
-    level='INFO',
-    format='{level} | {time} \n{message}',
-    rotation='10 kb',
-    retention='10 seconds',
-    compression='zip'
-)
+#===============================================================================
+# Connection data:
+# These are the pages that can be requested and the user agents that can make
+#   the requests. Connections store an index into these lists instead of the
+#   strings themselves.
+#===============================================================================
+PAGES = [
+    'home',
+    'about',
+    'forums',
+    'events/picnic',
+    'events',
+    'events/pool_party',
+    'events/programming_class'
+]
+
+USER_AGENTS = [
+    'Mozilla',
+    'Edge',
+    'Chrome',
+    'Safari'
+]
+
+# The lowest and highest value for each part of a random IP number.
+IP_LOWS = [20, 5, 20, 20]
+IP_HIGHS = [250, 250, 250, 250]
+
+# This function turns an IP number packed into a single int back into the
+#   usual dotted string.
+def ip_to_string(ip_number):
+    return '{}.{}.{}.{}'.format(
+        (ip_number >> 24) & 255,
+        (ip_number >> 16) & 255,
+        (ip_number >> 8) & 255,
+        ip_number & 255
+    )
 #===============================================================================
 
 
 #===============================================================================
 # Connection class:
 # The connection class holds the data for a connection and also generates that
-#   data randomly.
+#   data randomly. The IP is stored as a packed int and the page and user agent
+#   as indexes, and they are only turned into strings when they are used.
 #===============================================================================
 class Connection:
-    # constructor
-    def __init__(self):
+    # only these fields are stored, which keeps each connection small
+    __slots__ = ('ip_number', 'page', 'agent', 'timestamp')
+
+    # constructor that uses the given data or generates any that is missing
+    def __init__(self, ip_number=None, page=None, agent=None, timestamp=None):
         # generate a random IP number
-        self.ip = str(random.randint(20,250)) + \
-            '.' + str(random.randint(5,250)) + \
-            '.' + str(random.randint(20,250)) + \
-            '.' + str(random.randint(20,250))
+        if ip_number is None:
+            ip_number = 0
+
+            for low, high in zip(IP_LOWS, IP_HIGHS):
+                ip_number = (ip_number << 8) | random.randint(low, high)
 
         # generate a random file that is being requested
-        self.request = 'my_cool_website/' + random.choice([
-            'home',
-            'about',
-            'forums',
-            'events/picnic',
-            'events',
-            'events/pool_party',
-            'events/programming_class'
-        ]) + '.html'
+        if page is None:
+            page = random.randrange(len(PAGES))
 
         # generate some random user information
-        self.user_agent = random.choice([
-            'Mozilla',
-            'Edge',
-            'Chrome',
-            'Safari'
-        ])
+        if agent is None:
+            agent = random.randrange(len(USER_AGENTS))
 
         # generate a timestamp that represents when the request was received
-        self.timestamp = time.time()
+        if timestamp is None:
+            timestamp = time.time()
+
+        self.ip_number = ip_number
+        self.page = page
+        self.agent = agent
+        self.timestamp = timestamp
+
+    # the IP as a string
+    @property
+    def ip(self):
+        return ip_to_string(self.ip_number)
+
+    # the file that is being requested
+    @property
+    def request(self):
+        return 'my_cool_website/' + PAGES[self.page] + '.html'
+
+    # the user information
+    @property
+    def user_agent(self):
+        return USER_AGENTS[self.agent]
+#===============================================================================
+
+
+#===============================================================================
+# Connection_Factory class:
+# The connection factory generates connections in large batches with numpy
+#   instead of one random call at a time. A batch is three arrays (packed IPs,
+#   page indexes and user agent indexes) and Connection objects are only made
+#   from it when one is actually needed.
+#===============================================================================
+class Connection_Factory:
+    # constructor that sets how many connections are generated per batch
+    def __init__(self, batch_size=4096, seed=None):
+        self.batch_size = batch_size
+        self.rng = numpy.random.default_rng(seed)
+        self.lows = numpy.array(IP_LOWS, dtype=numpy.uint32)
+        self.highs = numpy.array(IP_HIGHS, dtype=numpy.uint32) + 1
+        self.shifts = numpy.array([24, 16, 8, 0], dtype=numpy.uint32)
+
+        # the batch that single connections are currently taken from
+        self.buffer = None
+        self.position = 0
+
+    # function that generates a batch of connection data as numpy arrays
+    def batch(self, count):
+        octets = self.rng.integers(
+            self.lows, self.highs, size=(count, 4), dtype=numpy.uint32
+        )
+
+        ip_numbers = numpy.bitwise_or.reduce(octets << self.shifts, axis=1)
+        pages = self.rng.integers(0, len(PAGES), size=count, dtype=numpy.uint8)
+        agents = self.rng.integers(
+            0, len(USER_AGENTS), size=count, dtype=numpy.uint8
+        )
+
+        return ip_numbers, pages, agents
+
+    # function that returns the position of the next connection in the current
+    #   batch, generating a new batch when the current one has been used up
+    def next_index(self):
+        if self.buffer is None or self.position >= self.batch_size:
+            # convert to python lists once per batch, which is much faster than
+            #   converting each numpy value on its own
+            self.buffer = [part.tolist() for part in self.batch(self.batch_size)]
+            self.position = 0
+
+        index = self.position
+        self.position += 1
+
+        return index
+
+    # function that returns a single connection from the current batch
+    def next(self):
+        index = self.next_index()
+        ip_numbers, pages, agents = self.buffer
+
+        return Connection(ip_numbers[index], pages[index], agents[index])
+
+    # function that returns a random IP as a string without making a whole
+    #   connection
+    def random_ip(self):
+        index = self.next_index()
+
+        return ip_to_string(self.buffer[0][index])
+#===============================================================================
+
+
+#===============================================================================
+# Load generator:
+# This function generates synthetic connections as fast as possible for a number
+#   of seconds and reports how many were made per second.
+#===============================================================================
+def run_load_generator(seconds=5, batch_size=1000000):
+    factory = Connection_Factory(batch_size)
+    generated = 0
+    started = time.perf_counter()
+
+    while time.perf_counter() - started < seconds:
+        ip_numbers, pages, agents = factory.batch(batch_size)
+        generated += len(ip_numbers)
+
+    elapsed = time.perf_counter() - started
+
+    logger.info(
+        '''
+            Load Generator:
+            Connections: {},
+            Seconds: {:.2f},
+            Connections per second: {:,.0f}
+            '''.format(generated, elapsed, generated / elapsed)
+    )
+
+    return generated / elapsed
+#===============================================================================
+
+
+#===============================================================================
+# Replayed_Connection class:
+# A replayed connection holds the data for a connection that was read from a
+#   log file instead of being generated, so its strings are stored as they are.
+#===============================================================================
+class Replayed_Connection:
+    # only these fields are stored, which keeps each connection small
+    __slots__ = ('ip', 'request', 'user_agent', 'timestamp')
+
+    # constructor that sets the connection data
+    def __init__(self, ip, request, user_agent, timestamp):
+        self.ip = ip
+        self.request = request
+        self.user_agent = user_agent
+        self.timestamp = timestamp
+#===============================================================================
+
+
+#===============================================================================
+# Log_Replayer class:
+# The log replayer reads an existing log file and turns it back into requests
+#   and responses that can be fed through the simulated server. It reads both
+#   common/combined format access logs and the web_server.log files written by
+#   this program. The file is memory mapped and read one line at a time, so even
+#   very large files use the same small amount of memory.
+#===============================================================================
+class Log_Replayer:
+    # pattern for a line of a common or combined format access log, like:
+    #   1.2.3.4 - - [10/Oct/2000:13:55:36 -0700] "GET /a.html HTTP/1.0" 200 99
+    access_log_line = re.compile(
+        r'(?P<ip>\S+) \S+ \S+ \[(?P<time>[^\]]+)\] ' + \
+        r'"\S+ (?P<request>\S+)[^"]*" \S+ \S+' + \
+        r'(?: "[^"]*" "(?P<user_agent>[^"]*)")?'
+    )
+
+    # pattern for the first line of each message in a web_server.log file
+    server_log_header = re.compile(r'(?P<level>[A-Z]+) \| (?P<time>\S+)\s*$')
+
+    # pattern for the fields inside a web_server.log message
+    server_log_field = re.compile(
+        r'\s*(?P<name>IP|Request|Data|User-Agent|Timestamp): (?P<value>.*?),?$'
+    )
+
+    # constructor that sets the file to read and how much faster than the
+    #   original timing it should be replayed. A speed of 0 replays the file
+    #   as fast as possible.
+    def __init__(self, path, speed=1.0):
+        self.path = path
+        self.speed = speed
+        self.skipped = 0 # lines that couldn't be read or had an unreadable time
+
+    # generator that yields each line of the file as a string
+    def lines(self):
+        with open(self.path, 'rb') as file:
+            # an empty file cannot be memory mapped, and there is nothing to
+            #   read from it anyway
+            if os.fstat(file.fileno()).st_size == 0:
+                return
+
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                for line in iter(data.readline, b''):
+                    yield line.decode('utf-8', 'replace').rstrip('\r\n')
+
+    # generator that yields a (time, kind, ip, request, user_agent) tuple for
+    #   every request or response found in the file, where kind is either
+    #   'request' or 'response'
+    def records(self):
+        # the web_server.log message that is currently being read
+        message = None
+
+        for line in self.lines():
+            match = self.access_log_line.match(line)
+
+            # every access log line is a request that was also responded to
+            if match:
+                record = self.server_log_record(message)
+                message = None
+
+                if record:
+                    yield record
+
+                # skip the line if its time is not in the expected format
+                try:
+                    moment = datetime.datetime.strptime(
+                        match.group('time'), '%d/%b/%Y:%H:%M:%S %z'
+                    ).timestamp()
+                except ValueError:
+                    self.skipped += 1
+                    continue
+
+                user_agent = match.group('user_agent') or '-'
+
+                yield (moment, 'request', match.group('ip'),
+                    match.group('request'), user_agent)
+                yield (moment, 'response', match.group('ip'),
+                    match.group('request'), user_agent)
+                continue
+
+            match = self.server_log_header.match(line)
+
+            # the start of a new web_server.log message
+            if match:
+                record = self.server_log_record(message)
+
+                if record:
+                    yield record
+
+                message = {'time': match.group('time')}
+                continue
+
+            # a line outside of a web_server.log message that isn't an access
+            #   log line either, like a malformed "-" request
+            if message is None:
+                if line.strip():
+                    self.skipped += 1
+
+                continue
+
+            if line.strip() == 'Request Received:':
+                message['kind'] = 'request'
+                continue
+
+            if line.strip() == 'Response Sent:':
+                message['kind'] = 'response'
+                continue
+
+            match = self.server_log_field.match(line)
+
+            if match:
+                message[match.group('name')] = match.group('value')
+
+        record = self.server_log_record(message)
+
+        if record:
+            yield record
+
+    # function that turns a web_server.log message into a record, or returns
+    #   None if it was not a request or response message
+    def server_log_record(self, message):
+        if not message or 'kind' not in message or 'IP' not in message:
+            return None
+
+        # skip the message if its time is not in the expected format
+        try:
+            moment = datetime.datetime.strptime(
+                message['time'], '%Y-%m-%dT%H:%M:%S.%f%z'
+            ).timestamp()
+        except ValueError:
+            self.skipped += 1
+            return None
+
+        return (
+            moment,
+            message['kind'],
+            message['IP'],
+            message.get('Request', message.get('Data', '-')),
+            message.get('User-Agent', '-')
+        )
+
+    # generator that yields a (delay, kind, connection) tuple for every record,
+    #   where delay is how many seconds to wait before handling it
+    def events(self):
+        previous = None
+
+        for moment, kind, ip, request, user_agent in self.records():
+            if previous is None or self.speed <= 0:
+                delay = 0
+            else:
+                delay = max(moment - previous, 0) / self.speed
+
+            previous = moment
+
+            yield delay, kind, Replayed_Connection(
+                ip, request, user_agent, moment
+            )
+#===============================================================================
+
+
+#===============================================================================
+# Count_Min_Sketch class:
+# The count min sketch keeps approximate counts for a stream of keys (like IP
+#   addresses) using a fixed amount of memory no matter how many different
+#   keys are seen. Counts can be overestimated but are never underestimated.
+#===============================================================================
+class Count_Min_Sketch:
+    # constructor that sets up a table of counters with one row per hash
+    #   function
+    def __init__(self, width=2048, depth=4):
+        self.width = width
+        self.depth = depth
+        self.table = [[0] * width for _ in range(depth)]
+
+        # a different salt for each row so each row hashes keys differently
+        self.salts = [random.getrandbits(32) for _ in range(depth)]
+
+    # function that adds to the count of a key and returns its new estimate
+    def add(self, key, amount=1):
+        estimate = None
+
+        for row, salt in zip(self.table, self.salts):
+            index = hash((salt, key)) % self.width
+            row[index] += amount
+
+            if estimate is None or row[index] < estimate:
+                estimate = row[index]
+
+        return estimate
+
+    # function that returns the estimated count of a key
+    def estimate(self, key):
+        return min(
+            row[hash((salt, key)) % self.width]
+            for row, salt in zip(self.table, self.salts)
+        )
+#===============================================================================
+
+
+#===============================================================================
+# Sliding_Window class:
+# The sliding window counts events over the last few seconds using a ring of
+#   one second buckets, so old events fall out of the window on their own.
+#===============================================================================
+class Sliding_Window:
+    # constructor that sets the length of the window in seconds
+    def __init__(self, seconds=10):
+        self.seconds = seconds
+        self.buckets = [0] * seconds
+        self.bucket_times = [0] * seconds
+
+    # function that records an event at the given time
+    def add(self, now, amount=1):
+        second = int(now)
+        index = second % self.seconds
+
+        # reset the bucket if it is holding counts from an older second
+        if self.bucket_times[index] != second:
+            self.bucket_times[index] = second
+            self.buckets[index] = 0
+
+        self.buckets[index] += amount
+
+    # function that returns the number of events per second over the window
+    def rate(self, now):
+        oldest = int(now) - self.seconds
+
+        total = sum(
+            count for count, second in zip(self.buckets, self.bucket_times)
+            if second > oldest
+        )
+
+        return total / self.seconds
+#===============================================================================
+
+
+#===============================================================================
+# Latency_Histogram class:
+# The latency histogram stores response times in buckets that grow by a fixed
+#   ratio, in the same spirit as an HDR histogram. Memory stays the same no
+#   matter how many responses are recorded and percentiles are accurate to
+#   within the bucket ratio.
+#===============================================================================
+class Latency_Histogram:
+    # constructor that sets up the buckets, from the smallest latency tracked
+    #   (in seconds) up to the largest
+    def __init__(self, lowest=0.001, highest=3600, ratio=1.1):
+        self.lowest = lowest
+        self.ratio = ratio
+        self.log_ratio = math.log(ratio)
+        self.counts = [0] * (self.bucket_index(highest) + 1)
+        self.total = 0
+        self.largest = 0
+
+    # function that finds which bucket a latency belongs in
+    def bucket_index(self, latency):
+        if latency <= self.lowest:
+            return 0
+
+        return int(math.log(latency / self.lowest) / self.log_ratio) + 1
+
+    # function that records a single latency
+    def add(self, latency):
+        index = min(self.bucket_index(latency), len(self.counts) - 1)
+
+        self.counts[index] += 1
+        self.total += 1
+        self.largest = max(self.largest, latency)
+
+    # function that returns the latency at a percentile (0 to 100)
+    def percentile(self, percent):
+        if self.total == 0:
+            return 0
+
+        needed = self.total * percent / 100
+        seen = 0
+
+        for index, count in enumerate(self.counts):
+            seen += count
+
+            if count and seen >= needed:
+                # report the upper edge of the bucket, but never more than the
+                #   largest latency actually seen
+                return min(self.lowest * self.ratio ** index, self.largest)
+
+        return self.largest
+#===============================================================================
+
+
+#===============================================================================
+# Traffic_Monitor class:
+# The traffic monitor is fed every request and response the server handles and
+#   keeps running totals for each requested page and each IP, request and
+#   response rates, and response latency. All of it uses a fixed amount of
+#   memory so it can run for as long as the server does.
+#===============================================================================
+class Traffic_Monitor:
+    # constructor that sets the thresholds used to decide when to warn
+    #   - ip_threshold: requests from one IP within the window
+    #   - latency_threshold: seconds for the 99th percentile response time
+    def __init__(self, window=10, ip_threshold=20, latency_threshold=5,
+        top_ips=10):
+        self.window = window
+        self.ip_threshold = ip_threshold
+        self.latency_threshold = latency_threshold
+        self.top_ips = top_ips
+
+        # The pages that can be requested are a small fixed list so they are
+        #   counted exactly. IPs could be anything so they go in the sketches.
+        self.path_counts = {}
+        self.ip_counts = Count_Min_Sketch()
+
+        # A second sketch and histogram that are cleared every window, used
+        #   for the warning thresholds so they are judged on recent traffic
+        #   only.
+        self.recent_ip_counts = Count_Min_Sketch()
+        self.recent_latency = Latency_Histogram()
+
+        # The window starts at the first time it is given, so the times can
+        #   come from any clock, like the times in a replayed log.
+        self.recent_started = None
+
+        # The heaviest IPs seen so far and in the current window, each limited
+        #   to a few entries.
+        self.heavy_ips = {}
+        self.recent_heavy_ips = {}
+
+        self.request_rate = Sliding_Window(window)
+        self.response_rate = Sliding_Window(window)
+        self.latency = Latency_Histogram()
+
+        self.total_requests = 0
+        self.total_responses = 0
+
+    # function that records a request that was received
+    def record_request(self, connection, now=None):
+        if now is None:
+            now = time.time()
+
+        self.check_window(now)
+
+        self.total_requests += 1
+        self.request_rate.add(now)
+        self.path_counts[connection.request] = \
+            self.path_counts.get(connection.request, 0) + 1
+
+        # the IP string is made once here since it is used four times
+        ip = connection.ip
+        self.track_heavy_ip(self.recent_heavy_ips, ip,
+            self.recent_ip_counts.add(ip))
+        self.track_heavy_ip(self.heavy_ips, ip, self.ip_counts.add(ip))
+
+    # function that records a response that was sent for a connection
+    def record_response(self, connection, now=None):
+        if now is None:
+            now = time.time()
+
+        self.check_window(now)
+
+        self.total_responses += 1
+        self.response_rate.add(now)
+        self.latency.add(now - connection.timestamp)
+        self.recent_latency.add(now - connection.timestamp)
+
+    # function that starts a new window for the recent IP counts and latency
+    #   if the old one is over
+    def check_window(self, now):
+        if self.recent_started is None:
+            self.recent_started = now
+        elif now - self.recent_started >= self.window:
+            self.recent_ip_counts = Count_Min_Sketch()
+            self.recent_latency = Latency_Histogram()
+            self.recent_heavy_ips = {}
+            self.recent_started = now
+
+    # function that adds an IP to a list of heaviest IPs and keeps the list
+    #   from growing past its limit
+    def track_heavy_ip(self, heavy_ips, ip, count):
+        if ip in heavy_ips or len(heavy_ips) < self.top_ips:
+            heavy_ips[ip] = count
+            return
+
+        lightest = min(heavy_ips, key=heavy_ips.get)
+
+        if count > heavy_ips[lightest]:
+            del heavy_ips[lightest]
+            heavy_ips[ip] = count
+
+    # function that returns a list of warning messages for any thresholds that
+    #   have been crossed
+    def check_thresholds(self, now=None):
+        if now is None:
+            now = time.time()
+
+        # don't warn about a window that has already ended
+        self.check_window(now)
+
+        warnings = []
+
+        for ip, recent in self.recent_heavy_ips.items():
+            if recent >= self.ip_threshold:
+                warnings.append(
+                    'High volumes of traffic are being generated from this ' +\
+                    'ip: {} ({} requests in {} seconds)'.format(
+                        ip, recent, self.window)
+                )
+
+        slowest = self.recent_latency.percentile(99)
+
+        if slowest >= self.latency_threshold:
+            warnings.append(
+                'Slow responses: 99% of responses in the last {} seconds ' \
+                'took up to {:.2f} seconds'.format(self.window, slowest)
+            )
+
+        return warnings
+
+    # function that returns the current totals, rates and latencies
+    def snapshot(self, now=None):
+        if now is None:
+            now = time.time()
+
+        return {
+            'total_requests': self.total_requests,
+            'total_responses': self.total_responses,
+            'requests_per_second': self.request_rate.rate(now),
+            'responses_per_second': self.response_rate.rate(now),
+            'paths': dict(self.path_counts),
+            'top_ips': sorted(
+                self.heavy_ips.items(), key=lambda item: item[1], reverse=True
+            ),
+            'latency_p50': self.latency.percentile(50),
+            'latency_p90': self.latency.percentile(90),
+            'latency_p99': self.latency.percentile(99),
+            'latency_max': self.latency.largest
+        }
+#===============================================================================
+
+
+#===============================================================================
+# Log_Sampler class:
+# The log sampler decides whether a log message should be written before any
+#   work is done to build it, so dropped messages cost almost nothing. Each
+#   level can keep only a fraction of its messages and can be limited to a
+#   number of messages per second for each IP. Messages at or above the
+#   keep_level are never dropped.
+#===============================================================================
+class Log_Sampler:
+    # constructor that sets how messages are sampled and limited
+    #   - rates: fraction of messages kept for each level, like {'INFO': 0.01}
+    #   - limits: most messages per second per IP for each level
+    #   - keep_level: messages at or above this level are always kept
+    def __init__(self, rates=None, limits=None, keep_level='CRITICAL'):
+        self.rates = rates or {}
+        self.limits = limits or {}
+        self.keep_level = logger.level(keep_level).no
+
+        # Whether each level is always kept, looked up once per level instead
+        #   of for every message.
+        self.always_kept = {
+            level: logger.level(level).no >= self.keep_level
+            for level in set(self.rates) | set(self.limits)
+        }
+
+        # The per IP counts for the current second, one count min sketch per
+        #   level. The sketches are replaced every second and use the same
+        #   amount of memory no matter how many IPs are seen. Like any count
+        #   min sketch they can overcount, so in a very large spike an IP may
+        #   be limited a little early, but never late.
+        self.counts = {}
+        self.window_started = time.time()
+
+        self.kept = {}
+        self.dropped = {}
+
+    # function that returns True if a message should be logged
+    def allow(self, level, connection=None):
+        if self.sample(level, connection):
+            self.kept[level] = self.kept.get(level, 0) + 1
+            return True
+
+        self.dropped[level] = self.dropped.get(level, 0) + 1
+        return False
+
+    # function that applies the keep level, sample rate and rate limit in
+    #   order from cheapest to most expensive
+    def sample(self, level, connection):
+        always_kept = self.always_kept.get(level)
+
+        if always_kept is None:
+            always_kept = logger.level(level).no >= self.keep_level
+            self.always_kept[level] = always_kept
+
+        if always_kept:
+            return True
+
+        rate = self.rates.get(level, 1)
+
+        if rate < 1 and random.random() >= rate:
+            return False
+
+        limit = self.limits.get(level)
+
+        if limit is None or connection is None:
+            return True
+
+        now = time.time()
+
+        if now - self.window_started >= 1:
+            self.counts = {}
+            self.window_started = now
+
+        counts = self.counts.get(level)
+
+        if counts is None:
+            counts = self.counts[level] = Count_Min_Sketch()
+
+        return counts.add(connection.ip) <= limit
+#===============================================================================
+
+
+#===============================================================================
+# Worker_Stats class:
+# The worker stats class keeps track of how much work one of the server's
+#   workers has done and how long requests waited in the queue before that
+#   worker picked them up.
+#===============================================================================
+class Worker_Stats:
+    # constructor that sets the worker's number and starts all counts at zero
+    def __init__(self, number):
+        self.number = number
+        self.handled = 0
+        self.busy = 0
+        self.waited = 0
+        self.longest_wait = 0
+
+    # function that records how long a request waited in the queue
+    def record_wait(self, seconds):
+        self.waited += seconds
+        self.longest_wait = max(self.longest_wait, seconds)
+
+    # function that records how long it took to handle a request
+    def record_handled(self, seconds):
+        self.handled += 1
+        self.busy += seconds
+
+    # function that returns the average time a request waited in the queue
+    def average_wait(self):
+        if self.handled == 0:
+            return 0
+
+        return self.waited / self.handled
+#===============================================================================
+
+
+#===============================================================================
+# Page rendering:
+# This function simulates the CPU heavy work of building a page for a request
+#   by hashing the request over and over. It is used by the thread and process
+#   worker pools and has to be a plain function so it can be sent to another
+#   process.
+#===============================================================================
+PAGE_RENDER_ROUNDS = 20000
+
+def render_page(request, rounds=PAGE_RENDER_ROUNDS):
+    digest = request.encode()
+
+    for _ in range(rounds):
+        digest = hashlib.sha256(digest).digest()
+
+    return digest.hex()
 #===============================================================================
 
 
@@ -149,10 +937,105 @@ class Simulated_Server:
 
     # constructor that sets the number of ticks to be performed before asking
     #   the user if they want to continue the simulation and starts the async
-    #   loop for the simulated server.
-    def __init__(self, ticks):
+    #   loop for the simulated server. If a log replayer is given, the traffic
+    #   from its log file is replayed instead of random traffic.
+    #   - workers: number of workers that handle requests at the same time, or
+    #     0 to send one response at a time from the tick loop
+    #   - pool: 'async' for workers that wait on simulated I/O, or 'thread' or
+    #     'process' for workers that render pages in a thread or process pool
+    #   - service_time: average seconds an async worker takes per request
+    #   - sampler: decides which log messages are written, by default all
+    def __init__(self, ticks, replayer=None, workers=0, pool='async',
+        service_time=0.5, sampler=None):
         self.ticks_remaining = ticks
-        asyncio.run(self.tick())
+        self.monitor = Traffic_Monitor() # keeps live traffic statistics
+        self.factory = Connection_Factory() # generates random connections
+        self.sampler = sampler or Log_Sampler()
+        self.workers = workers
+        self.pool = pool
+        self.service_time = service_time
+
+        asyncio.run(self.run(replayer))
+
+    # Async function that starts the workers, if there are any, and then runs
+    #   either the random simulation or the replay.
+    async def run(self, replayer):
+        if self.workers > 0:
+            self.start_workers()
+
+        if replayer is None:
+            await self.tick()
+        else:
+            await self.replay(replayer)
+
+    # function that creates the request queue and the workers that take
+    #   requests from it
+    def start_workers(self):
+        # The queue only holds a few requests per worker, so when the workers
+        #   fall behind, adding a request waits instead of using more memory.
+        self.queue = asyncio.Queue(maxsize=self.workers * 4)
+        self.workers_started = time.perf_counter()
+
+        # the thread or process pool that pages are rendered in
+        if self.pool == 'thread':
+            self.executor = concurrent.futures.ThreadPoolExecutor(self.workers)
+        elif self.pool == 'process':
+            self.executor = concurrent.futures.ProcessPoolExecutor(self.workers)
+        else:
+            self.executor = None
+
+        self.worker_stats = [Worker_Stats(number + 1) \
+            for number in range(self.workers)]
+
+        self.worker_tasks = [asyncio.create_task(self.worker(stats)) \
+            for stats in self.worker_stats]
+
+    # Async function run by each worker that takes requests from the queue,
+    #   handles them and sends the response, until the simulation ends.
+    async def worker(self, stats):
+        loop = asyncio.get_running_loop()
+
+        while True:
+            queued, connection = await self.queue.get()
+
+            started = time.perf_counter()
+            stats.record_wait(started - queued)
+
+            # A failed request is logged and the worker moves on, and the
+            #   request is always marked done so stop_workers doesn't wait on
+            #   it forever.
+            try:
+                if self.executor is None:
+                    # simulate waiting on a database or disk, async
+                    await asyncio.sleep(
+                        random.uniform(0, 2 * self.service_time)
+                    )
+                else:
+                    await loop.run_in_executor(
+                        self.executor, render_page, connection.request
+                    )
+
+                self.log_response(connection) # log the response
+                self.monitor.record_response(connection) # count the response
+
+                stats.record_handled(time.perf_counter() - started)
+            except Exception:
+                logger.exception(
+                    'Worker {} failed to handle a request.', stats.number
+                )
+            finally:
+                self.queue.task_done()
+
+    # Async function that waits for the queued requests to be handled and then
+    #   stops the workers.
+    async def stop_workers(self):
+        await self.queue.join()
+
+        for task in self.worker_tasks:
+            task.cancel()
+
+        if self.executor is not None:
+            self.executor.shutdown()
 
     # Async function that generates random server events and loops until 
     #   user ends the simulation.
@@ -160,24 +1043,30 @@ class Simulated_Server:
         # If the timer has run out for the simulation prompt the user to 
         #   continue or quit.
         if self.ticks_remaining < 1:
+            self.log_snapshot() # show the traffic statistics so far
+
             if input('Continue simulation for 20 more seconds? (Y or N): ')\
                 .upper() == 'Y':
                 
                 self.ticks_remaining = 40
             else:
+                if self.workers > 0:
+                    await self.stop_workers() # finish the requests still queued
+
                 print('Exiting simulation.')
                 exit()
 
         # randomly generate a request being received
         if random.randint(1,4) == 1:
-            self.request_received(Connection())
+            await self.request_received(self.factory.next())
 
-        # randomly generate a response being sent
-        if random.randint(1,4) == 1:
+        # randomly generate a response being sent, unless the workers are
+        #   sending the responses
+        if self.workers == 0 and random.randint(1,4) == 1:
             self.send_response()
 
-        # randomly generate a warning event
-        if random.randint(1,10) == 1:
+        # check the traffic statistics for warnings every 10 ticks
+        if self.ticks_remaining % 10 == 0:
             self.generate_warning()
 
         # randomly generate an error event
@@ -189,11 +1078,59 @@ class Simulated_Server:
         await asyncio.sleep(.5) # wait for half a second, async
         await self.tick() # call this tick method again to continue loop
 
-    # function that simulates the processing of a request    
-    def request_received(self, connection):
+    # Async function that feeds the requests and responses from a log file
+    #   through the server, waiting between them to match the original timing.
+    async def replay(self, replayer):
+        last_check = time.time()
+
+        for delay, kind, connection in replayer.events():
+            if delay > 0:
+                await asyncio.sleep(delay) # wait for the next event, async
+
+            if kind == 'request':
+                # The timestamp is changed to when the request is received in
+                #   the replay, so response latency is measured for this run.
+                connection.timestamp = time.time()
+                await self.request_received(connection)
+            elif self.workers == 0:
+                # the workers send their own responses, so the responses in
+                #   the log are only replayed when there are no workers
+                self.send_response()
+
+            # check the traffic statistics for warnings every 5 seconds, the
+            #   same as every 10 ticks of the simulation
+            if time.time() - last_check >= 5:
+                self.generate_warning()
+                last_check = time.time()
+
+        if self.workers > 0:
+            await self.stop_workers() # finish the requests still queued
+
+        # check for warnings once more, since a fast replay can finish before
+        #   the first 5 second check
+        self.generate_warning()
+        self.log_snapshot() # show the traffic statistics for the whole replay
+
+        if replayer.skipped:
+            logger.warning(
+                '''
+            WARNING: Skipped {} lines that could not be read.
+                '''.format(replayer.skipped)
+            )
+
+        print('Replay finished.')
+
+    # Async function that simulates the processing of a request. It waits if
+    #   the workers' queue is full.
+    async def request_received(self, connection):
         self.log_request(connection) # log the request
-        
-        self.requests.append(connection) # add the request to the request list
+        self.monitor.record_request(connection) # count the request
+
+        # give the request to the workers, or add it to the request list
+        if self.workers > 0:
+            await self.queue.put((time.perf_counter(), connection))
+        else:
+            self.requests.append(connection)
 
     # function that simulates the processing of a response
     @logger.catch
@@ -211,38 +1148,116 @@ class Simulated_Server:
             return False
 
         self.log_response(request) # log the response
+        self.monitor.record_response(request) # count the response
 
-    # function that generates a log message using a connection's data
+    # function that generates a log message using a connection's data. The
+    #   template is filled in by the handlers (see render_message), and is
+    #   skipped entirely if the sampler drops it.
     def log_request(self, connection):
-        logger.info(
+        if not self.sampler.allow('INFO', connection):
+            return
+
+        logger.bind(connection=connection).info(
             '''
             Request Received:
-            IP: {ip},
-            Request: {req},
-            User-Agent: {ua}
-            '''.format(ip=connection.ip,req=connection.request, \
-                ua=connection.user_agent)
+            IP: {connection.ip},
+            Request: {connection.request},
+            User-Agent: {connection.user_agent}
+            '''
         )
 
-    # function that generates a log message using a connection's data
+    # function that generates a log message using a connection's data. The
+    #   template is filled in by the handlers (see render_message), and is
+    #   skipped entirely if the sampler drops it.
     def log_response(self, connection):
-        logger.info(
+        if not self.sampler.allow('INFO', connection):
+            return
+
+        logger.bind(connection=connection).info(
             '''
             Response Sent:
-            IP: {ip},
-            Data: {req},
-            Timestamp: {ts}
-            '''.format(ip=connection.ip,req=connection.request, \
-                ts=connection.timestamp)
+            IP: {connection.ip},
+            Data: {connection.request},
+            Timestamp: {connection.timestamp}
+            '''
         )
 
-    # function that generates a warning message
+    # function that generates a warning message for each traffic threshold
+    #   that has been crossed
     def generate_warning(self):
-        logger.warning(
+        for warning in self.monitor.check_thresholds():
+            if not self.sampler.allow('WARNING'):
+                continue
+
+            logger.warning(
+                '''
+            WARNING: {}
+                '''.format(warning)
+            )
+
+    # function that logs the current traffic statistics
+    def log_snapshot(self):
+        snapshot = self.monitor.snapshot()
+
+        logger.info(
             '''
-            WARNING: High volumes of traffic are being generated from this 
-            ip: {} 
-            '''.format(Connection().ip)
+            Traffic Statistics:
+            Requests: {total_requests} ({requests_per_second:.2f}/s),
+            Responses: {total_responses} ({responses_per_second:.2f}/s),
+            Pages: {paths},
+            Top IPs: {top_ips},
+            Latency p50/p90/p99/max: {latency_p50:.2f}s / {latency_p90:.2f}s /
+                {latency_p99:.2f}s / {latency_max:.2f}s
+            '''.format(**snapshot)
+        )
+
+        if self.workers > 0:
+            self.log_worker_stats()
+
+        if self.sampler.dropped:
+            self.log_sampler_stats()
+
+    # function that logs how many messages the sampler has kept and dropped
+    def log_sampler_stats(self):
+        levels = sorted(set(self.sampler.kept) | set(self.sampler.dropped))
+
+        logger.info(
+            '''
+            Log Sampling:
+            {}
+            '''.format('\n            '.join(
+                '{}: {} kept, {} dropped'.format(
+                    level,
+                    self.sampler.kept.get(level, 0),
+                    self.sampler.dropped.get(level, 0)
+                )
+                for level in levels
+            ))
+        )
+
+    # function that logs how much work each worker has done
+    def log_worker_stats(self):
+        elapsed = time.perf_counter() - self.workers_started
+
+        lines = [
+            'Worker {}: {} handled ({:.2f}/s), {:.0%} busy, ' \
+                'wait avg {:.3f}s max {:.3f}s'.format(
+                stats.number,
+                stats.handled,
+                stats.handled / elapsed,
+                stats.busy / elapsed,
+                stats.average_wait(),
+                stats.longest_wait
+            )
+            for stats in self.worker_stats
+        ]
+
+        logger.info(
+            '''
+            Worker Statistics ({} {} workers, {} queued):
+            {}
+            '''.format(self.workers, self.pool, self.queue.qsize(),
+                '\n            '.join(lines))
         )
 
     # function that generates a crital message
@@ -250,17 +1265,111 @@ class Simulated_Server:
         logger.critical(
             '''
             CRITICAL: Lost connection to SQL server at this ip: {}
-            '''.format(Connection().ip)
+            '''.format(self.factory.random_ip())
         )
 #===============================================================================
 
 
 #===============================================================================
-# Setting up and starting the simulation
+# Reading the command line options and starting the simulation
+# This only runs when the file is run directly, and not when it is imported by
+#   the worker processes of the process pool.
 #===============================================================================
-# Display a message to the user about the simulation.
-print(
-    '''
+if __name__ == '__main__':
+    setup_logger()
+
+    parser = argparse.ArgumentParser(
+        description='Simulated web server that logs its activity with loguru.'
+    )
+    parser.add_argument(
+        '--load',
+        type=float,
+        metavar='SECONDS',
+        help='run the synthetic connection load generator for this many ' + \
+            'seconds instead of the simulation'
+    )
+    parser.add_argument(
+        '--replay',
+        metavar='LOG_FILE',
+        help='replay the requests and responses from an access log or a ' + \
+            'copy of a web_server.log file instead of random traffic'
+    )
+    parser.add_argument(
+        '--speed',
+        type=float,
+        default=1.0,
+        help='how many times faster than the original timing to replay the ' + \
+            'log file, or 0 to replay it as fast as possible (default: 1)'
+    )
+    parser.add_argument(
+        '--workers',
+        type=int,
+        default=0,
+        help='number of workers that handle requests at the same time, ' + \
+            'or 0 to send one response at a time (default: 0)'
+    )
+    parser.add_argument(
+        '--pool',
+        choices=['async', 'thread', 'process'],
+        default='async',
+        help='async workers wait on simulated I/O, thread and process ' + \
+            'workers render pages in a thread or process pool (default: async)'
+    )
+    parser.add_argument(
+        '--service-time',
+        type=float,
+        default=0.5,
+        help='average seconds an async worker takes per request (default: 0.5)'
+    )
+    parser.add_argument(
+        '--sample',
+        action='append',
+        default=[],
+        metavar='LEVEL=RATE',
+        help='keep only this fraction of the messages at a level, like ' + \
+            'INFO=0.01 (can be given more than once)'
+    )
+    parser.add_argument(
+        '--limit',
+        action='append',
+        default=[],
+        metavar='LEVEL=COUNT',
+        help='keep at most this many messages per second for each IP at a ' + \
+            'level, like INFO=5 (can be given more than once)'
+    )
+    options = parser.parse_args()
+
+    # Turn the LEVEL=VALUE options into the sampler's settings.
+    try:
+        sampler = Log_Sampler(
+            {level.upper(): float(value) for level, value in \
+                (option.split('=', 1) for option in options.sample)},
+            {level.upper(): int(value) for level, value in \
+                (option.split('=', 1) for option in options.limit)}
+        )
+    except ValueError:
+        parser.error('--sample and --limit must look like LEVEL=VALUE')
+
+    # Run the load generator on its own if it was asked for.
+    if options.load:
+        run_load_generator(options.load)
+        exit()
+
+    # Replay the log file on its own if it was asked for.
+    if options.replay:
+        Simulated_Server(
+            0,
+            Log_Replayer(options.replay, options.speed),
+            options.workers,
+            options.pool,
+            options.service_time,
+            sampler
+        )
+        exit()
+
+    # Display a message to the user about the simulation.
+    print(
+        '''
 #===============================================================================
         Hello, this program simulates a server that is sending and 
         receiving data to and from various connections and uses the 
@@ -273,22 +1382,28 @@ print(
         normal to showcase the library. The sending and receiving of 
         data is completely random.
 #===============================================================================
-    '''
-)
+        '''
+    )
 
-input('Press any key to continue:') # wait for user input to continue
+    input('Press any key to continue:') # wait for user input to continue
 
-# Explain how the simulation will progress
-print(
-    '''
+    # Explain how the simulation will progress
+    print(
+        '''
     The server simulation will last about 20 seconds and then a prompt
     to continue the simulation will displayed.
-    '''
-    )
+        '''
+        )
 
-# Trigger to start the simulation
-input('\nPress any key to start the simulation:')
+    # Trigger to start the simulation
+    input('\nPress any key to start the simulation:')
 
-Simulated_Server(40)
+    Simulated_Server(
+        40,
+        workers=options.workers,
+        pool=options.pool,
+        service_time=options.service_time,
+        sampler=sampler
+    )
 
 #===============================================================================
\ No newline at end of file